@@ -1,24 +1,48 @@
 import os
+import multiprocessing
+import hashlib
 import zipfile
 import tempfile
 import random
 import shutil
 import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from queue import Full, Queue
 
 import numpy as np
 import pydicom
 import streamlit as st
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
+from PIL import PdfParser
 
-from typing import Tuple
+from rendering import image_percentiles, normalize_image, render_page
 
-def read_dicom_image(file_path: str) -> Tuple[np.ndarray, dict]:
+from typing import List, Optional, Tuple
+
+DICOM_EXTENSIONS = ('.dcm', '.dicom')
+MAX_PENDING_PAGES = 2 * (os.cpu_count() or 1)
+CACHE_ROOT = os.path.join(tempfile.gettempdir(), 'dicom2pdf_cache')
+# Cached uploads hold patient data; drop any not used for this long.
+CACHE_MAX_AGE_SECONDS = 60 * 60
+# The metadata read_dicom_image() reports, plus what pixel_array needs to decode.
+DICOM_TAGS = [
+    'PatientName', 'SeriesDescription', 'InstanceNumber', 'SliceLocation', 'StudyDate', 'Modality',
+    'Rows', 'Columns', 'PixelData', 'FloatPixelData', 'DoubleFloatPixelData', 'BitsAllocated', 'BitsStored',
+    'HighBit', 'PixelRepresentation', 'SamplesPerPixel', 'PhotometricInterpretation', 'PlanarConfiguration',
+    'NumberOfFrames',
+]
+
+def read_dicom_image(file_path: str, dicom_data: pydicom.Dataset) -> Tuple[np.ndarray, dict]:
     try:
-        dicom_data = pydicom.dcmread(file_path)
         try:
-            image_array = dicom_data.pixel_array
+            # Decode from a Dataset read for this call alone; the header
+            # Dataset from find_dicom_files() is never modified, so callers
+            # can reuse it, and it never ends up holding a decoded slice.
+            image_array = pydicom.dcmread(file_path, specific_tags=DICOM_TAGS).pixel_array
         except Exception as e:
             return None, None
 
@@ -37,133 +61,306 @@ def read_dicom_image(file_path: str) -> Tuple[np.ndarray, dict]:
     except:
         return None, None
 
-def normalize_image(image_array: np.ndarray, contrast_factor=0.9) -> np.ndarray:
-    image_array = image_array.astype(np.float64)
-    p2, p98 = np.percentile(image_array, [2, 98])
-    image_array = np.clip(image_array, p2, p98)
-    img_min = np.min(image_array)
-    img_max = np.max(image_array)
-    if img_max > img_min:
-        image_array = (image_array - img_min) / (img_max - img_min)
-    return np.power(image_array, contrast_factor)
-
-def find_dicom_files(folder_path: str):
-    extensions = ['.dcm', '.dicom']
-    dicom_files = []
-    for path in Path(folder_path).rglob('*'):
-        if path.is_file():
-            if path.suffix.lower() in extensions or not path.suffix:
-                try:
-                    pydicom.dcmread(str(path), stop_before_pixels=True)
-                    dicom_files.append(str(path))
-                except:
-                    pass
-    return dicom_files
-
-def convert_to_pdf(dicom_folder: str, output_pdf: str, contrast_factor: float = 0.9, dpi: int = 200):
-    dicom_files = find_dicom_files(dicom_folder)
-    if not dicom_files:
+@st.cache_data(show_spinner=False, max_entries=256)
+def load_slice(file_path: str, mtime: float, _dicom_data: pydicom.Dataset) -> Tuple[np.ndarray, Tuple[float, float], dict]:
+    # Keyed on path + mtime only (the Dataset is not hashed), so moving the
+    # contrast or DPI slider reuses the decoded pixels and their percentiles.
+    image_array, metadata = read_dicom_image(file_path, _dicom_data)
+    if image_array is None:
+        return None, None, None
+    return image_array, image_percentiles(image_array), metadata
+
+def read_dicom_header(path: Path) -> Optional[pydicom.Dataset]:
+    # pydicom rejects files without the 'DICM' marker after the 128-byte
+    # preamble, so check it directly before parsing any of the header.
+    # Only DICOM_TAGS are parsed, and parsing stops before the pixel data,
+    # which read_dicom_image() reads separately.
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(132)
+        if header[128:132] != b'DICM':
+            return None
+        return pydicom.dcmread(str(path), stop_before_pixels=True, specific_tags=DICOM_TAGS)
+    except Exception:
         return None
 
-    with PdfPages(output_pdf) as pdf:
-        for i, file_path in enumerate(dicom_files):
-            image_array, metadata = read_dicom_image(file_path)
-            if image_array is None:
-                continue
+def is_dicom_candidate(path: Path) -> bool:
+    return path.suffix.lower() in DICOM_EXTENSIONS or not path.suffix
 
-            norm_img = normalize_image(image_array, contrast_factor)
+def find_dicom_files(folder_path: str) -> List[Tuple[str, pydicom.Dataset]]:
+    candidates = [path for path in Path(folder_path).rglob('*')
+                  if path.is_file() and is_dicom_candidate(path)]
+    # Reading a header is dominated by open/read latency, so overlap it across threads.
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        headers = list(executor.map(read_dicom_header, candidates))
+    return [(str(path), dataset) for path, dataset in zip(candidates, headers) if dataset is not None]
 
-            fig, ax = plt.subplots(figsize=(10, 10), facecolor='black')
-            ax.imshow(norm_img, cmap='gray', vmin=0, vmax=1)
-            ax.set_facecolor('black')
-            ax.axis('off')
+@st.cache_resource(show_spinner=False)
+def get_render_pool() -> ProcessPoolExecutor:
+    # One pool per server. Workers are spawned rather than forked from the
+    # multi-threaded Streamlit process; they run render_page from rendering.py,
+    # and the UI below sits behind a __main__ guard, so a worker importing
+    # app.py as __mp_main__ makes no Streamlit calls.
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('spawn'))
 
-            title = f"{metadata.get('patient_name', '')} | {metadata.get('series_description', '')}"
-            fig.suptitle(title, fontsize=12, y=0.95, color='white')
+def start_pdf(pdf: PdfParser.PdfParser):
+    pdf.start_writing()
+    pdf.write_header()
+    # Pages are written as they are rendered, so reserve the page tree's
+    # object now and write the tree itself once every page is known.
+    pdf.pages_ref = pdf.next_object_id(0)
 
-            fig.text(0.5, 0.02, 'DICOM2PDF - By Mohmad AlJasem https://aljasem.eu.org', 
-                     ha='center', va='bottom', fontsize=10, color='white')
+def write_pdf_page(pdf: PdfParser.PdfParser, page: Tuple[str, Tuple[int, int], bytes], dpi: int):
+    # Embeds the worker's JPEG bytes as-is (DCTDecode), laid out the way
+    # Pillow's own PDF writer lays out an 'L'/'RGB' page at this resolution.
+    mode, (width, height), jpeg = page
+    gray = mode == 'L'
+    image_ref = pdf.write_obj(None, stream=jpeg, Type=PdfParser.PdfName('XObject'),
+                              Subtype=PdfParser.PdfName('Image'), Width=width, Height=height,
+                              Filter=PdfParser.PdfName('DCTDecode'), BitsPerComponent=8,
+                              ColorSpace=PdfParser.PdfName('DeviceGray' if gray else 'DeviceRGB'))
+    page_width, page_height = width * 72.0 / dpi, height * 72.0 / dpi
+    contents_ref = pdf.write_obj(None, stream=b"q %f 0 0 %f 0 0 cm /image Do Q\n" % (page_width, page_height))
+    procset = PdfParser.PdfName('ImageB' if gray else 'ImageC')
+    resources = PdfParser.PdfDict(ProcSet=[PdfParser.PdfName('PDF'), procset], XObject=PdfParser.PdfDict(image=image_ref))
+    pdf.pages.append(pdf.write_page(None, Resources=resources, MediaBox=[0, 0, page_width, page_height],
+                                    Contents=contents_ref))
 
-            pdf.savefig(fig, bbox_inches='tight', pad_inches=0.1, facecolor=fig.get_facecolor(), dpi=dpi)
-            plt.close(fig)
+def finish_pdf(pdf: PdfParser.PdfParser):
+    pdf.write_obj(pdf.pages_ref, Type=PdfParser.PdfName('Pages'), Count=len(pdf.pages), Kids=pdf.pages)
+    pdf.write_xref_and_trailer(pdf.write_obj(None, Type=PdfParser.PdfName('Catalog'), Pages=pdf.pages_ref))
+
+def put_unless_stopped(slice_queue: Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            slice_queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+def read_slices(dicom_files: List[Tuple[str, pydicom.Dataset]], slice_queue: Queue, stop: threading.Event):
+    # Ends the stream with None, or with the exception that stopped it, so
+    # convert_to_pdf can tell a finished series from a failed one.
+    try:
+        for file_path, dataset in dicom_files:
+            dicom_slice = load_slice(file_path, os.path.getmtime(file_path), dataset)
+            if not put_unless_stopped(slice_queue, dicom_slice, stop):
+                return
+        end = None
+    except Exception as exc:
+        end = exc
+    put_unless_stopped(slice_queue, end, stop)
+
+def convert_to_pdf(dicom_folder: str, output_pdf: str, contrast_factor: float = 0.9, dpi: int = 200,
+                   dicom_files: Optional[List[Tuple[str, pydicom.Dataset]]] = None):
+    if dicom_files is None:
+        dicom_files = find_dicom_files(dicom_folder)
+    if not dicom_files:
+        return None
+
+    # A reader thread decodes slices into a bounded queue while the process
+    # pool renders the ones already read, overlapping disk reads with the
+    # CPU-bound page rendering. At most MAX_PENDING_PAGES slices are in the
+    # pool at once; their JPEG-encoded pages are collected in file order and
+    # written straight into the PDF, in a single pass over the output.
+    executor = get_render_pool()
+    slice_queue = Queue(maxsize=4)
+    stop = threading.Event()
+    reader = threading.Thread(target=read_slices, args=(dicom_files, slice_queue, stop), daemon=True)
+    reader.start()
+    pending = deque()
+    pdf = PdfParser.PdfParser(filename=output_pdf, mode='w+b')
+
+    def collect_oldest():
+        write_pdf_page(pdf, pending.popleft().result(), dpi)
+
+    try:
+        start_pdf(pdf)
+        for item in iter(slice_queue.get, None):
+            if isinstance(item, Exception):
+                raise item
+            image_array, percentiles, metadata = item
+            if image_array is not None:
+                pending.append(executor.submit(render_page, image_array, percentiles, metadata,
+                                               contrast_factor, dpi))
+            if len(pending) > MAX_PENDING_PAGES:
+                collect_oldest()
+        while pending:
+            collect_oldest()
+        finish_pdf(pdf)
+    except BrokenProcessPool:
+        # A dead worker (e.g. OOM-killed) breaks the pool for good; let the
+        # next conversion start a fresh one.
+        get_render_pool.clear()
+        raise
+    finally:
+        stop.set()
+        for future in pending:
+            future.cancel()
+        reader.join()
+        pdf.close()
+    if not pdf.pages:
+        return None
 
     return output_pdf
 
-def extract_archive(archive_path: str, extract_to: str):
+def extract_archive(archive_path: str, extract_to: str) -> bool:
     if archive_path.endswith(".zip"):
         with zipfile.ZipFile(archive_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_to)
+            # Only materialize entries find_dicom_files() could accept; entries
+            # without an extension are kept only if they carry the DICM marker.
+            for info in zip_ref.infolist():
+                entry_path = Path(info.filename)
+                if info.is_dir() or info.file_size < 132 or not is_dicom_candidate(entry_path):
+                    continue
+                if not entry_path.suffix:
+                    with zip_ref.open(info) as entry:
+                        if entry.read(132)[128:132] != b'DICM':
+                            continue
+                zip_ref.extract(info, extract_to)
+        return True
     elif archive_path.endswith(".rar"):
-        subprocess.run(["unrar", "x", "-y", archive_path, extract_to], check=False)
+        return subprocess.run(["unrar", "x", "-y", archive_path, extract_to], check=False).returncode == 0
     elif archive_path.endswith(".iso"):
-        subprocess.run(["7z", "x", archive_path, f"-o{extract_to}"], check=False)
-
-# Streamlit app
-st.set_page_config(page_title="DICOM to PDF Converter", page_icon="🧠", layout="centered")
-st.markdown("""
-    <style>
-        .main {background-color: #f5f5f5;}
-        footer {visibility: hidden;}
-        .custom-footer {
-            position: fixed;
-            bottom: 0;
-            width: 100%;
-            text-align: center;
-            font-size: 14px;
-            color: #888;
-            padding: 10px;
-            background-color: #ffffff;
-        }
-    </style>
-    <script async src="https://www.googletagmanager.com/gtag/js?id=G-XXXXXXX"></script>
-    <script>
-      window.dataLayer = window.dataLayer || [];
-      function gtag(){dataLayer.push(arguments);}
-      gtag('js', new Date());
-      gtag('config', 'G-XXXXXXX');
-    </script>
-""", unsafe_allow_html=True)
-
-st.title("🧠 DICOM to PDF Converter")
-st.write("Upload a **.zip**, **.rar**, or **.iso** file containing your DICOM images. We'll generate a high-quality PDF scan for you.")
-
-uploaded_archive = st.file_uploader("Upload compressed DICOM archive", type=["zip", "rar", "iso"])
-
-contrast_factor = st.slider("Adjust Contrast", 0.5, 1.5, 0.9, step=0.05)
-dpi = st.slider("Set PDF Resolution (DPI)", 100, 300, 200, step=10)
-
-if uploaded_archive:
-    with st.spinner("Processing your DICOM files..."):
-        with tempfile.TemporaryDirectory() as temp_dir:
-            archive_path = os.path.join(temp_dir, uploaded_archive.name)
-            with open(archive_path, "wb") as f:
-                f.write(uploaded_archive.read())
-
-            extract_archive(archive_path, temp_dir)
-            dicom_files = find_dicom_files(temp_dir)
-            if dicom_files:
-                st.subheader("📸 Image Preview")
-                preview_files = random.sample(dicom_files, min(10, len(dicom_files)))
-                for file in preview_files:
-                    image_array, metadata = read_dicom_image(file)
-                    if image_array is not None:
-                        norm_img = normalize_image(image_array, contrast_factor)
-                        st.image(norm_img, caption=str(file), use_column_width=True, clamp=True)
-
-            output_pdf_path = os.path.join(temp_dir, "output.pdf")
-            result = convert_to_pdf(temp_dir, output_pdf_path, contrast_factor=contrast_factor, dpi=dpi)
-
-            if result and os.path.exists(output_pdf_path):
-                with open(output_pdf_path, "rb") as f:
-                    st.success("✅ PDF successfully created!")
-                    st.download_button("📥 Download PDF", f, file_name="dicom_scan.pdf", mime="application/pdf")
+        return subprocess.run(["7z", "x", archive_path, f"-o{extract_to}"], check=False).returncode == 0
+    return False
+
+def prepare_cache(archive_hash: str) -> str:
+    # The cache root is private to the server user, and entries idle for
+    # longer than CACHE_MAX_AGE_SECONDS are removed whenever an upload is
+    # processed; the current entry is touched so it stays fresh.
+    os.makedirs(CACHE_ROOT, mode=0o700, exist_ok=True)
+    os.chmod(CACHE_ROOT, 0o700)
+    now = time.time()
+    for entry in os.scandir(CACHE_ROOT):
+        if entry.name == archive_hash:
+            continue
+        try:
+            expired = now - entry.stat().st_mtime > CACHE_MAX_AGE_SECONDS
+        except FileNotFoundError:
+            continue  # evicted concurrently by another session
+        if expired:
+            shutil.rmtree(entry.path, ignore_errors=True)
+    cache_dir = os.path.join(CACHE_ROOT, archive_hash)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.utime(cache_dir)
+    return cache_dir
+
+def archive_digest(uploaded_archive) -> str:
+    # Hashing a multi-GB upload takes seconds, so do it once per upload
+    # rather than on every slider rerun.
+    digests = st.session_state.setdefault('archive_digests', {})
+    if uploaded_archive.file_id not in digests:
+        digests[uploaded_archive.file_id] = hashlib.blake2b(uploaded_archive.getbuffer(), digest_size=16).hexdigest()
+    return digests[uploaded_archive.file_id]
+
+def show_download(pdf_path: str):
+    with open(pdf_path, "rb") as f:
+        st.success("✅ PDF successfully created!")
+        st.download_button("📥 Download PDF", f, file_name="dicom_scan.pdf", mime="application/pdf")
+
+def main():
+    st.set_page_config(page_title="DICOM to PDF Converter", page_icon="🧠", layout="centered")
+    st.markdown("""
+        <style>
+            .main {background-color: #f5f5f5;}
+            footer {visibility: hidden;}
+            .custom-footer {
+                position: fixed;
+                bottom: 0;
+                width: 100%;
+                text-align: center;
+                font-size: 14px;
+                color: #888;
+                padding: 10px;
+                background-color: #ffffff;
+            }
+        </style>
+        <script async src="https://www.googletagmanager.com/gtag/js?id=G-XXXXXXX"></script>
+        <script>
+          window.dataLayer = window.dataLayer || [];
+          function gtag(){dataLayer.push(arguments);}
+          gtag('js', new Date());
+          gtag('config', 'G-XXXXXXX');
+        </script>
+    """, unsafe_allow_html=True)
+
+    st.title("🧠 DICOM to PDF Converter")
+    st.write("Upload a **.zip**, **.rar**, or **.iso** file containing your DICOM images. We'll generate a high-quality PDF scan for you.")
+
+    uploaded_archive = st.file_uploader("Upload compressed DICOM archive", type=["zip", "rar", "iso"])
+
+    contrast_factor = st.slider("Adjust Contrast", 0.5, 1.5, 0.9, step=0.05)
+    dpi = st.slider("Set PDF Resolution (DPI)", 100, 300, 200, step=10)
+
+    if uploaded_archive:
+        with st.spinner("Processing your DICOM files..."):
+            # Uploads are cached by content hash: a re-upload skips extraction and
+            # scanning, and reuses the PDF if it was built with the same settings.
+            cache_dir = prepare_cache(archive_digest(uploaded_archive))
+            extract_dir = os.path.join(cache_dir, "extracted")
+            output_pdf_path = os.path.join(cache_dir, f"output_c{contrast_factor!r}_d{dpi}.pdf")
+
+            if os.path.exists(output_pdf_path):
+                show_download(output_pdf_path)
             else:
-                st.error("Failed to generate PDF. Please check your files.")
-else:
-    st.info("Please upload a compressed folder containing DICOM files.")
-
-st.markdown("""
-    <div class="custom-footer">
-        Developed By <a href="https://aljasem.eu.org" target="_blank">Mohamad AlJasem</a>
-    </div>
-""", unsafe_allow_html=True)
+                with tempfile.TemporaryDirectory(dir=cache_dir) as temp_dir:
+                    dicom_dir = extract_dir
+                    if not os.path.isdir(extract_dir):
+                        archive_path = os.path.join(temp_dir, uploaded_archive.name)
+                        # Copy in 1 MiB chunks rather than materializing a second
+                        # full-size bytes object for multi-GB ISO/RAR uploads.
+                        uploaded_archive.seek(0)
+                        with open(archive_path, "wb") as f:
+                            shutil.copyfileobj(uploaded_archive, f, length=1 << 20)
+
+                        staging_dir = os.path.join(temp_dir, "extracted")
+                        os.makedirs(staging_dir)
+                        if extract_archive(archive_path, staging_dir):
+                            try:
+                                os.rename(staging_dir, extract_dir)
+                            except OSError:
+                                pass  # extracted concurrently by another session
+                        else:
+                            # Convert whatever was extracted, but only for this run:
+                            # neither the files nor the PDF go into the cache.
+                            st.warning("The archive could not be fully extracted; converting the files that were.")
+                            dicom_dir = staging_dir
+
+                    dicom_files = find_dicom_files(dicom_dir)
+                    if dicom_files:
+                        st.subheader("📸 Image Preview")
+                        preview_files = random.sample(dicom_files, min(10, len(dicom_files)))
+                        for file, dataset in preview_files:
+                            image_array, percentiles, metadata = load_slice(file, os.path.getmtime(file), dataset)
+                            if image_array is not None:
+                                norm_img = normalize_image(image_array, contrast_factor, percentiles)
+                                # Strided view down to ~512 px instead of the full-resolution slice.
+                                thumb = norm_img[::max(1, norm_img.shape[0] // 512), ::max(1, norm_img.shape[1] // 512)]
+                                st.image(thumb, caption=str(file), width="stretch")
+
+                    # Sessions share one process, so each conversion needs its own
+                    # partial file; only a finished PDF is moved into the cache.
+                    fd, partial_pdf_path = tempfile.mkstemp(dir=temp_dir, suffix='.partial')
+                    os.close(fd)
+                    result = convert_to_pdf(dicom_dir, partial_pdf_path, contrast_factor=contrast_factor,
+                                            dpi=dpi, dicom_files=dicom_files)
+                    if not result:
+                        st.error("Failed to generate PDF. Please check your files.")
+                    elif dicom_dir == extract_dir:
+                        os.replace(partial_pdf_path, output_pdf_path)
+                        show_download(output_pdf_path)
+                    else:
+                        show_download(partial_pdf_path)
+    else:
+        st.info("Please upload a compressed folder containing DICOM files.")
+
+    st.markdown("""
+        <div class="custom-footer">
+            Developed By <a href="https://aljasem.eu.org" target="_blank">Mohamad AlJasem</a>
+        </div>
+    """, unsafe_allow_html=True)
+
+if __name__ == "__main__":
+    main()
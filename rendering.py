@@ -0,0 +1,196 @@
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+from functools import lru_cache
+from typing import Optional, Tuple
+
+PAGE_INCHES = 10
+FOOTER_TEXT = 'DICOM2PDF - By Mohmad AlJasem https://aljasem.eu.org'
+
+def native_byte_order(image_array: np.ndarray) -> np.ndarray:
+    # Explicit VR Big Endian files decode to e.g. '>i2' arrays; the unsigned
+    # views and the Numba kernel below read raw bytes in native order.
+    return image_array.astype(image_array.dtype.newbyteorder('='), copy=False)
+
+def integer_percentiles(image_array: np.ndarray, lower=2, upper=98) -> Tuple[float, float]:
+    # DICOM pixels are usually 12-16 bit integers: a histogram and its
+    # cumulative sum give the percentiles in one linear pass, without sorting.
+    image_array = native_byte_order(image_array)
+    if image_array.dtype.itemsize <= 2:
+        # Count the unsigned view of the pixel bits (no upcast or min/max
+        # pass), then roll the bins back from bit-pattern to value order.
+        offset = int(np.iinfo(image_array.dtype).min)
+        bits = image_array.view(f'u{image_array.dtype.itemsize}').ravel()
+        hist = np.roll(np.bincount(bits, minlength=1 << (8 * image_array.dtype.itemsize)), -offset)
+    else:
+        flat = image_array.ravel()
+        offset = int(flat.min())
+        if int(flat.max()) - offset >= (1 << 16):
+            p_low, p_high = np.percentile(flat, [lower, upper])
+            return p_low, p_high
+        shifted = flat.astype(np.intp)
+        shifted -= offset
+        hist = np.bincount(shifted)
+    cdf = np.cumsum(hist)
+    total = cdf[-1]
+    p_low = int(np.searchsorted(cdf, total * lower / 100)) + offset
+    p_high = int(np.searchsorted(cdf, total * upper / 100)) + offset
+    return p_low, p_high
+
+def image_percentiles(image_array: np.ndarray) -> Tuple[float, float]:
+    if np.issubdtype(image_array.dtype, np.integer):
+        return integer_percentiles(image_array)
+    p2, p98 = np.percentile(image_array, [2, 98])
+    return p2, p98
+
+def scale_image(image_array: np.ndarray, p2: float, p98: float) -> np.ndarray:
+    # float32 halves memory traffic versus float64; every step after the
+    # (copying) astype runs in place on the same buffer.
+    image_array = image_array.astype(np.float32)
+    p2, p98 = np.float32(p2), np.float32(p98)
+    np.clip(image_array, p2, p98, out=image_array)
+    value_range = p98 - p2
+    if value_range > 0:
+        image_array -= p2
+        image_array *= np.float32(1.0 / value_range)
+    else:
+        # Flat slice: nothing to stretch, so saturate it like a [0, 1] window.
+        image_array.fill(min(max(p2, 0), 1))
+    return image_array
+
+def apply_contrast(scaled_img: np.ndarray, contrast_factor=0.9, fast_gamma=True) -> np.ndarray:
+    if fast_gamma:
+        # x**g == exp(g * log(x)); numpy has SIMD exp/log loops on far more
+        # CPUs than it has for a non-integer pow. log(0) -> -inf -> exp -> 0.
+        with np.errstate(divide='ignore'):
+            np.log(scaled_img, out=scaled_img)
+        scaled_img *= np.float32(contrast_factor)
+        np.exp(scaled_img, out=scaled_img)
+    else:
+        np.power(scaled_img, np.float32(contrast_factor), out=scaled_img)
+    return scaled_img
+
+def to_uint8(norm_img: np.ndarray) -> np.ndarray:
+    # Scale straight into the uint8 buffer, without a float temporary.
+    pixels = np.empty(norm_img.shape, dtype=np.uint8)
+    np.multiply(norm_img, 255, out=pixels, casting='unsafe')
+    return pixels
+
+def contrast_lut(dtype: np.dtype, p2: float, p98: float, contrast_factor=0.9, fast_gamma=True) -> np.ndarray:
+    # One entry per possible pixel value; only the [p2, p98] window needs the
+    # scale + gamma math, everything outside it is clipped to the edges.
+    info = np.iinfo(dtype)
+    low, high = int(p2), int(p98)
+    window = to_uint8(apply_contrast(scale_image(np.arange(low, high + 1), p2, p98), contrast_factor, fast_gamma))
+    lut = np.empty(info.max - info.min + 1, dtype=np.uint8)
+    lut[:low - info.min] = window[0]
+    lut[low - info.min:high - info.min + 1] = window
+    lut[high - info.min + 1:] = window[-1]
+    # Reorder from value order to the unsigned bit pattern used as the index,
+    # so signed pixels need no offset pass.
+    return np.roll(lut, info.min)
+
+if njit is not None:
+    # Serial on purpose: slices are already spread across the render pool's
+    # processes, and a numba thread pool per process (or one started in the
+    # Streamlit process before the pool spawns) only oversubscribes the CPUs.
+    @njit(fastmath=True, cache=True)
+    def normalize_kernel(flat, p2, p98, offset, inv_range, gamma, out):
+        for i in range(flat.shape[0]):
+            value = min(max(flat[i], p2), p98)
+            out[i] = ((value - offset) * inv_range) ** gamma * 255
+
+def normalize_fused(image_array: np.ndarray, p2: float, p98: float, contrast_factor=0.9) -> np.ndarray:
+    # Same result as to_uint8(apply_contrast(scale_image(...))) in a single
+    # pass over the pixels instead of one pass per step.
+    value_range = p98 - p2
+    if value_range > 0:
+        offset, inv_range = p2, 1.0 / value_range
+    else:
+        offset, inv_range = p2 - min(max(p2, 0), 1), 1.0
+    flat = np.ascontiguousarray(image_array).ravel()
+    out = np.empty(flat.shape, dtype=np.uint8)
+    normalize_kernel(flat, np.float32(p2), np.float32(p98), np.float32(offset),
+                     np.float32(inv_range), np.float32(contrast_factor), out)
+    return out.reshape(image_array.shape)
+
+def normalize_image(image_array: np.ndarray, contrast_factor=0.9,
+                    percentiles: Optional[Tuple[float, float]] = None, fast_gamma=True) -> np.ndarray:
+    image_array = native_byte_order(image_array)
+    p2, p98 = percentiles if percentiles is not None else image_percentiles(image_array)
+    # For 8/16-bit integer pixels, clip + scale + gamma collapse into a single
+    # gather from a lookup table that fits in cache.
+    if np.issubdtype(image_array.dtype, np.integer) and image_array.dtype.itemsize <= 2:
+        lut = contrast_lut(image_array.dtype, p2, p98, contrast_factor, fast_gamma)
+        return np.take(lut, image_array.view(f'u{image_array.dtype.itemsize}'))
+    # The fused kernel's fastmath power is itself an approximation, so it
+    # only stands in for the fast_gamma path.
+    if njit is not None and fast_gamma:
+        return normalize_fused(image_array, p2, p98, contrast_factor)
+    return to_uint8(apply_contrast(scale_image(image_array, p2, p98), contrast_factor, fast_gamma))
+
+@lru_cache(maxsize=None)
+def load_font(size: int):
+    try:
+        return ImageFont.truetype("DejaVuSans.ttf", size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+def draw_centered_text(draw: ImageDraw.ImageDraw, text: str, center_y: int, font, page_width: int):
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    x = (page_width - (right - left)) // 2 - left
+    y = center_y - (bottom - top) // 2 - top
+    draw.text((x, y), text, font=font, fill='white')
+
+@lru_cache(maxsize=4)
+def page_template(mode: str, dpi: int) -> Image.Image:
+    # The page background and footer never change, so draw them once per
+    # mode/DPI (per worker process) and copy the result for every slice.
+    page_size = PAGE_INCHES * dpi
+    bottom_margin = int(page_size * 0.05)
+    page = Image.new(mode, (page_size, page_size), 'black')
+    draw_centered_text(ImageDraw.Draw(page), FOOTER_TEXT, page_size - bottom_margin // 2,
+                       load_font(round(10 * dpi / 72)), page_size)
+    return page
+
+def compose_page(norm_img: np.ndarray, title: str, dpi: int) -> Image.Image:
+    page_size = PAGE_INCHES * dpi
+    top_margin = int(page_size * 0.08)
+    bottom_margin = int(page_size * 0.05)
+    # Pillow wraps a contiguous uint8 grayscale array without copying it.
+    slice_img = Image.fromarray(norm_img)
+    # Monochrome slices get a single-channel page: a third of the samples for
+    # the PDF writer's JPEG encoder, and a DeviceGray image in the output.
+    page = page_template('L' if slice_img.mode == 'L' else 'RGB', dpi).copy()
+
+    box_height = page_size - top_margin - bottom_margin
+    scale = min(page_size / slice_img.width, box_height / slice_img.height)
+    fitted_size = (max(1, round(slice_img.width * scale)), max(1, round(slice_img.height * scale)))
+    slice_img = slice_img.resize(fitted_size, Image.Resampling.LANCZOS)
+    page.paste(slice_img, ((page_size - fitted_size[0]) // 2,
+                           top_margin + (box_height - fitted_size[1]) // 2))
+
+    # Font sizes are in points; convert to pixels at the requested page DPI.
+    draw_centered_text(ImageDraw.Draw(page), title, top_margin // 2, load_font(round(12 * dpi / 72)), page_size)
+    return page
+
+def encode_page(page: Image.Image) -> bytes:
+    # The same lossy JPEG (quality 95) Pillow's PDF writer would embed for an
+    # 'L'/'RGB' page, encoded here so the PDF can be assembled by copying bytes.
+    buffer = io.BytesIO()
+    page.save(buffer, format='JPEG', quality=95)
+    return buffer.getvalue()
+
+def render_page(image_array: np.ndarray, percentiles: Tuple[float, float], metadata: dict,
+                contrast_factor: float, dpi: int) -> Tuple[str, Tuple[int, int], bytes]:
+    norm_img = normalize_image(image_array, contrast_factor, percentiles)
+    title = f"{metadata.get('patient_name', '')} | {metadata.get('series_description', '')}"
+    page = compose_page(norm_img, title, dpi)
+    return page.mode, page.size, encode_page(page)
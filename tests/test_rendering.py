@@ -0,0 +1,57 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from rendering import image_percentiles, normalize_image
+
+
+def reference_normalize(image_array, contrast_factor, p2, p98):
+    # The original float64 clip + scale + gamma, as uint8.
+    scaled = (np.clip(image_array.astype(np.float64), p2, p98) - p2) / (p98 - p2)
+    return (np.power(scaled, contrast_factor) * 255).astype(np.uint8)
+
+
+class NormalizeImageTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.signed = rng.integers(-1024, 3072, size=(64, 64)).astype(np.int16)
+
+    def assert_close(self, actual, expected):
+        self.assertEqual(actual.dtype, np.uint8)
+        self.assertLessEqual(int(np.abs(actual.astype(int) - expected.astype(int)).max()), 1)
+
+    def test_signed_input(self):
+        p2, p98 = np.percentile(self.signed, [2, 98])
+        self.assert_close(normalize_image(self.signed, 0.9, (p2, p98)),
+                          reference_normalize(self.signed, 0.9, p2, p98))
+
+    def test_big_endian_input(self):
+        big_endian = self.signed.astype('>i2')
+        p2, p98 = np.percentile(self.signed, [2, 98])
+        self.assert_close(normalize_image(big_endian, 0.9, (p2, p98)),
+                          reference_normalize(self.signed, 0.9, p2, p98))
+        np.testing.assert_array_equal(normalize_image(big_endian, 0.9), normalize_image(self.signed, 0.9))
+
+    def test_exact_gamma_for_float_input(self):
+        image_array = self.signed.astype(np.float32) / 7
+        p2, p98 = np.percentile(image_array, [2, 98])
+        scaled = (np.clip(image_array, np.float32(p2), np.float32(p98)) - np.float32(p2)) / np.float32(p98 - p2)
+        expected = (np.power(scaled, np.float32(0.9)) * 255).astype(np.uint8)
+        with mock.patch('rendering.normalize_fused') as normalize_fused:
+            actual = normalize_image(image_array, 0.9, (p2, p98), fast_gamma=False)
+        normalize_fused.assert_not_called()
+        np.testing.assert_array_equal(actual, expected)
+
+class ImagePercentilesTest(unittest.TestCase):
+    def test_matches_numpy(self):
+        rng = np.random.default_rng(0)
+        for dtype in ('<i2', '>i2', '<u2', '>u2', 'i1', 'u1', '>i4'):
+            info = np.iinfo(np.dtype(dtype))
+            image_array = rng.integers(max(info.min, -2000), min(info.max, 4000), size=(64, 64)).astype(dtype)
+            expected = np.percentile(image_array, [2, 98], method='inverted_cdf')
+            self.assertEqual(tuple(image_percentiles(image_array)), tuple(expected), dtype)
+
+
+if __name__ == '__main__':
+    unittest.main()